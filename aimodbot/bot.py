@@ -1,18 +1,47 @@
 # aimodbot - a maubot plugin to moderate messages and files in rooms using AI.
 
 from typing import Type
+from collections import OrderedDict
 import json
 import base64
 import asyncio
+import time
+import random
+import hashlib
+import re
 
+import aiohttp
 from mautrix.client import Client, InternalEventType, MembershipEventDispatcher, SyncStream
 from mautrix.types import (Event, StateEvent, UserID, EventType,
-                            MediaMessageEventContent, MessageEvent, RoomID, MessageType)
-from mautrix.errors import MNotFound
+                            MediaMessageEventContent, MessageEvent, RoomID, MessageType,
+                            PowerLevelStateEventContent)
+from mautrix.errors import MNotFound, MatrixError
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 from maubot import Plugin
 from maubot.handlers import event
 
+# orjson is optional, it only speeds up (de)serializing AI requests and responses
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+    json_loads = json.loads
+
+try:
+    import numpy as np
+    from fastembed import TextEmbedding
+except ImportError:
+    np = None
+    TextEmbedding = None
+
+# Message types that are sent to the AI as images
+_MEDIA_MSGTYPES = frozenset({MessageType.IMAGE, MessageType.VIDEO, MessageType.STICKER})
+
+# Defaults for the message type filter
+_DEFAULT_MSGTYPES = frozenset({"m.text", "m.image"})
+_DEFAULT_MIMETYPES = frozenset({"image/jpeg", "image/png", "image/webp", "image/gif"})
+
 
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
@@ -26,6 +55,10 @@ class Config(BaseProxyConfig):
         helper.copy("allowed_msgtypes")
         helper.copy("allowed_mimetypes")
         helper.copy("enable_msgtype_filter")
+        helper.copy("min_moderation_chars")
+        helper.copy("batch_window_ms")
+        helper.copy("enable_semantic_cache")
+        helper.copy("semantic_cache_threshold")
 
 
 class AIModerator(Plugin):
@@ -38,17 +71,30 @@ class AIModerator(Plugin):
         "i'm unable to",
         "i can't"
     ]
+    REFUSAL_RE = re.compile("|".join(re.escape(phrase) for phrase in REFUSAL_PHRASES), re.IGNORECASE)
 
-    async def start(self) -> None:
-        await super().start()
-        self.config.load_and_update()
-        self.client.add_dispatcher(MembershipEventDispatcher)
+    # How long (in seconds) a room's power levels are cached before being fetched again
+    PL_CACHE_TTL = 60
 
-    async def stop(self) -> None:
-        await super().stop()
+    # Retry behaviour for requests to the AI endpoint
+    MAX_RETRIES = 3
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    RETRY_BASE_DELAY = 1.0
+    RETRY_MAX_DELAY = 30.0
+    RETRY_JITTER = 1.0
 
-    async def ai_analyze(self, msg) -> None:
-        sys_prompt = """
+    # Ratings are cached by content hash so repeated (spam) messages don't trigger another AI request
+    SCORE_CACHE_SIZE = 5000
+    SCORE_CACHE_TTL = 3600
+
+    # Rating cache keys of media by mxc URL, so reposts with a cached rating aren't downloaded again
+    MEDIA_CACHE_SIZE = 5000
+
+    # Semantic cache for near-duplicate text messages (requires numpy and fastembed)
+    SEMANTIC_CACHE_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+    SEMANTIC_CACHE_SIZE = 1000
+
+    _SYS_PROMPT = """
 You are a content moderation engine. It is critical that you consistently respond with valid JSON. assess the included
 message content and identify whether it is a potential scam or spam message, includes excessive whitespace or other
 spammy formatting intended to overwhelm users clients, or is otherwise inappropriate content. rate the message based on
@@ -74,19 +120,198 @@ all integers are on a scale between 0-10.
 score included, such as "likely scam (8)" or "offensive content (9)". "analysis" should be one or two brief sentences
 that explain how the score was reached. It is imperative that you return a response in this exact format for the
 programmatic content moderation system to work.
-        """
-        
+    """
+    # Shared between requests, never mutated
+    _SYS_MSG = {"role": "system", "content": _SYS_PROMPT}
+    _BATCH_SYS_MSG = {"role": "system", "content": _SYS_PROMPT + """
+You will be given several messages at once as a JSON array of strings. rate each message independently and return ONLY
+a JSON array containing exactly one object in the format above for each message, in the same order as the messages.
+    """}
+
+    # Maximum number of text messages rated in a single request when batching is enabled
+    BATCH_SIZE = 8
+
+    async def start(self) -> None:
+        await super().start()
+        self.config.load_and_update()
+        self._batch_queue: asyncio.Queue = asyncio.Queue()
+        self._batch_requests: set[asyncio.Task] = set()
+        self._batch_task = None
+        self._semantic_model = None
+        self._load_config()
+        self.client.add_dispatcher(MembershipEventDispatcher)
+        self._pl_cache: dict[RoomID, tuple[float, PowerLevelStateEventContent]] = {}
+        # Long-lived session for the AI endpoint so connections (and TLS handshakes) are reused across calls
+        self._ai_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, limit_per_host=16, keepalive_timeout=75, ttl_dns_cache=300),
+            # Slow vision completions on local endpoints can take minutes, so keep aiohttp's default 5 minute limit
+            timeout=aiohttp.ClientTimeout(total=300, sock_connect=30),
+        )
+        self._score_cache: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._media_cache: OrderedDict[str, str] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+
+        self._embedder = None
+        if self.config["enable_semantic_cache"]:
+            if TextEmbedding is None:
+                self.log.warning("enable_semantic_cache is set, but numpy and fastembed are not installed. "
+                                 "semantic caching is disabled.")
+            else:
+                # Loading may download the model, and an optional cache must never keep moderation from starting
+                try:
+                    self._embedder = await asyncio.to_thread(TextEmbedding, self.SEMANTIC_CACHE_MODEL)
+                except Exception as e:
+                    self.log.warning(f"Failed to load embedding model {self.SEMANTIC_CACHE_MODEL}: {e}. "
+                                     "semantic caching is disabled.")
+
+    async def stop(self) -> None:
+        await super().stop()
+        if self._batch_task:
+            self._batch_task.cancel()
+            await asyncio.gather(self._batch_task, return_exceptions=True)
+        # Batches still being rated would otherwise run against the closed session below
+        while self._batch_requests:
+            batch_requests = list(self._batch_requests)
+            for task in batch_requests:
+                task.cancel()
+            await asyncio.gather(*batch_requests, return_exceptions=True)
+        while not self._batch_queue.empty():
+            _, fut = self._batch_queue.get_nowait()
+            if not fut.done():
+                fut.set_result(None)
+        await self._ai_session.close()
+
+    def on_external_config_update(self) -> None:
+        super().on_external_config_update()
+        self._load_config()
+
+    def _load_config(self) -> None:
+        """Apply config values that are kept outside of self.config"""
+        self.admins = frozenset(self.config["admins"] or ())
+        self.allowed_msgtypes = frozenset(self.config.get("allowed_msgtypes", _DEFAULT_MSGTYPES))
+        self.allowed_mimetypes = frozenset(self.config.get("allowed_mimetypes", _DEFAULT_MIMETYPES))
+
+        # Ratings from another model must not be reused for similar messages
+        if self._semantic_model != self.config["ai_mod_api_model"]:
+            self._reset_semantic_cache()
+
+        # Start or stop batching when batch_window_ms is changed. A stopped worker hands off what it has queued.
+        batching = self.config["batch_window_ms"] > 0
+        if batching and not self._batch_task:
+            self._batch_task = asyncio.create_task(self._batch_worker())
+        elif not batching and self._batch_task:
+            self._batch_task.cancel()
+            # Tracked so stop() still waits for it to hand off its queue
+            self._batch_requests.add(self._batch_task)
+            self._batch_task.add_done_callback(self._batch_requests.discard)
+            self._batch_task = None
+
+    async def _get_power_levels(self, room_id: RoomID) -> PowerLevelStateEventContent:
+        """Get the power levels of a room, using a short-lived cache to avoid repeated fetches"""
+        cached = self._pl_cache.get(room_id)
+        if cached and time.monotonic() < cached[0]:
+            return cached[1]
+        power_levels = await self.client.get_state_event(room_id, EventType.ROOM_POWER_LEVELS)
+        self._pl_cache[room_id] = (time.monotonic() + self.PL_CACHE_TTL, power_levels)
+        return power_levels
+
+    def _score_cache_key(self, content: bytes) -> str:
+        return hashlib.blake2b(content + self.config["ai_mod_api_model"].encode()).hexdigest()
+
+    def _get_cached_score(self, key: str):
+        cached = self._score_cache.get(key)
+        if not cached:
+            return None
+        if time.monotonic() >= cached[0]:
+            del self._score_cache[key]
+            return None
+        self._score_cache.move_to_end(key)
+        return cached[1]
+
+    def _cache_score(self, key: str, score: dict) -> None:
+        self._score_cache[key] = (time.monotonic() + self.SCORE_CACHE_TTL, score)
+        self._score_cache.move_to_end(key)
+        if len(self._score_cache) > self.SCORE_CACHE_SIZE:
+            self._score_cache.popitem(last=False)
+
+    def _cache_media(self, url: str, cache_key: str) -> None:
+        self._media_cache[url] = cache_key
+        self._media_cache.move_to_end(url)
+        if len(self._media_cache) > self.MEDIA_CACHE_SIZE:
+            self._media_cache.popitem(last=False)
+
+    async def _embed(self, text: str):
+        """Compute a normalized embedding of a text, so cosine similarity is a plain dot product"""
+        embedding = await asyncio.to_thread(lambda: next(iter(self._embedder.embed([text]))))
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return embedding / (np.linalg.norm(embedding) or 1.0)
+
+    def _reset_semantic_cache(self) -> None:
+        self._semantic_model = self.config["ai_mod_api_model"]
+        self._semantic_embeddings = None
+        self._semantic_expires = None
+        self._semantic_scores: list[dict] = []
+        self._semantic_next = 0
+
+    def _get_semantic_score(self, embedding):
+        if not self._semantic_scores:
+            return None
+        count = len(self._semantic_scores)
+        similarities = self._semantic_embeddings[:count] @ embedding
+        # Expired entries never match
+        similarities[self._semantic_expires[:count] <= time.monotonic()] = -1.0
+        best = int(np.argmax(similarities))
+        if similarities[best] > self.config["semantic_cache_threshold"]:
+            return self._semantic_scores[best]
+        return None
+
+    def _cache_semantic_score(self, embedding, score: dict) -> None:
+        if self._semantic_embeddings is None:
+            self._semantic_embeddings = np.zeros((self.SEMANTIC_CACHE_SIZE, embedding.shape[0]), dtype=np.float32)
+            self._semantic_expires = np.zeros(self.SEMANTIC_CACHE_SIZE)
+        # Ring buffer: once full, overwrite the oldest entry
+        self._semantic_embeddings[self._semantic_next] = embedding
+        self._semantic_expires[self._semantic_next] = time.monotonic() + self.SCORE_CACHE_TTL
+        if len(self._semantic_scores) < self.SEMANTIC_CACHE_SIZE:
+            self._semantic_scores.append(score)
+        else:
+            self._semantic_scores[self._semantic_next] = score
+        self._semantic_next = (self._semantic_next + 1) % self.SEMANTIC_CACHE_SIZE
+
+    @event.on(EventType.ROOM_POWER_LEVELS)
+    async def invalidate_power_levels(self, evt: StateEvent) -> None:
+        self._pl_cache.pop(evt.room_id, None)
+
+    async def ai_analyze(self, msg) -> None:
         # Prepare the content based on message type
         if isinstance(msg.content, MediaMessageEventContent):
             if not self.config["moderate_files"]:
                 return None
+
+        embedding = None
                 
         # Download and encode the file
-        if msg.content.msgtype in (MessageType.IMAGE, MessageType.VIDEO, MessageType.STICKER):
+        if msg.content.msgtype in _MEDIA_MSGTYPES:
             try:
+                # A repost of known media can reuse its rating without being downloaded again
+                cache_key = self._media_cache.get(msg.content.url)
+                if cache_key:
+                    self._media_cache.move_to_end(msg.content.url)
+                    cached = self._get_cached_score(cache_key)
+                    if cached:
+                        return cached
                 data = await self.client.download_media(msg.content.url)
-                mime_type = msg.content.info.mimetype
-                base64_data = base64.b64encode(data).decode('utf-8')
+                cache_key = self._score_cache_key(data)
+                self._cache_media(msg.content.url, cache_key)
+                cached = self._get_cached_score(cache_key)
+                if cached:
+                    return cached
+                mime_type = getattr(msg.content.info, "mimetype", None) or "application/octet-stream"
+                data_url = await asyncio.to_thread(
+                    lambda: f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+                )
+                # Let the raw file be freed while the request is in flight
+                del data
             
                 # Prepare content for OpenAI API
                 content = [
@@ -97,11 +322,11 @@ programmatic content moderation system to work.
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:{mime_type};base64,{base64_data}"
+                            "url": data_url
                         }
                     }
                 ]
-            except Exception as e:
+            except (MatrixError, aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
                 self.log.error(f"Failed to process media: {e}")
                 return None
         else:
@@ -112,59 +337,178 @@ programmatic content moderation system to work.
                 self.log.debug(f"DEBUG message {msg.event_id} has no formatted body. falling back to plaintext body.")
                 content = msg.content.body
                 self.log.debug(f"DEBUG message body for analysis: {content}")
+            # Key the cache on exactly what is sent for analysis, so a cached rating can't be reused for other content
+            cache_key = self._score_cache_key((content or "").strip().lower().encode())
+            cached = self._get_cached_score(cache_key)
+            if cached:
+                return cached
+            if self._embedder and content:
+                embedding = await self._embed(content)
+                cached = self._get_semantic_score(embedding)
+                if cached:
+                    self.log.debug(f"DEBUG message {msg.event_id} matched a semantically similar cached rating")
+                    return cached
+
+        # If an identical message is already being analyzed, wait for that result instead of asking again
+        if cache_key in self._inflight:
+            return await asyncio.shield(self._inflight[cache_key])
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[cache_key] = fut
+        rating_json = None
+        try:
+            if self._batch_task and isinstance(content, str):
+                rating_json = await self._queue_rating(content)
+            else:
+                rating_json = await self._rate(content)
+            if rating_json:
+                self._cache_score(cache_key, rating_json)
+                if embedding is not None:
+                    self._cache_semantic_score(embedding, rating_json)
+        finally:
+            fut.set_result(rating_json)
+            del self._inflight[cache_key]
+        return rating_json
 
+    async def _rate(self, content, sys_msg: dict = None):
         context = [
-            {"role": "system", "content": sys_prompt},
+            sys_msg or self._SYS_MSG,
             {"role": "user", "content": content},
         ]
         headers = {
             "Content-Type": "application/json",
+            "Connection": "keep-alive",
             "Authorization": f"Bearer {self.config['ai_mod_api_key']}",
         }
         data = {"model": self.config["ai_mod_api_model"], "messages": context}
+        return await self._request_rating(data, headers)
 
-        max_retries = 3
-        retries = 0
-        for attempt in range(max_retries):
-            async with self.http.post(
-                self.config["ai_mod_api_endpoint"], headers=headers, data=json.dumps(data)
-            ) as response:
-                if response.status != 200:
-                    return f"Error: {await response.text()}"
-                response_json = await response.json()
-                resp_content = response_json["choices"][0]["message"]["content"]
-                #self.log.debug(f"DEBUG response content: {resp_content}")
-                try:
-                    rating_json = json.loads(resp_content)
-                    return rating_json
-                except json.JSONDecodeError as e:
-                    if any(phrase in resp_content.lower() for phrase in self.REFUSAL_PHRASES):
-                        self.log.debug("LLM indicated content blocking - treating as high risk content")
-                        return {"max": 10, 
-                            "comment": "LLM indicated content blocking", 
-                            "analysis": resp_content, 
-                            "categories": {"unsafe": 10}
-                            }
+    async def _queue_rating(self, content: str):
+        """Queue a text message to be rated together with others arriving within batch_window_ms"""
+        fut = asyncio.get_running_loop().create_future()
+        await self._batch_queue.put((content, fut))
+        return await fut
+
+    async def _batch_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = [await self._batch_queue.get()]
+                deadline = loop.time() + self.config["batch_window_ms"] / 1000
+                while len(batch) < self.BATCH_SIZE:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._batch_queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                # Keep collecting the next batch while this one is being rated
+                self._start_batch(batch)
+                batch = []
+        except asyncio.CancelledError:
+            # Hand off whatever was already queued, so no caller is left waiting
+            while not self._batch_queue.empty():
+                batch.append(self._batch_queue.get_nowait())
+            for i in range(0, len(batch), self.BATCH_SIZE):
+                self._start_batch(batch[i:i + self.BATCH_SIZE])
+            raise
+
+    def _start_batch(self, batch: list[tuple[str, asyncio.Future]]) -> None:
+        task = asyncio.create_task(self._rate_batch(batch))
+        self._batch_requests.add(task)
+        task.add_done_callback(self._batch_requests.discard)
+
+    async def _rate_batch(self, batch: list[tuple[str, asyncio.Future]]) -> None:
+        results = None
+        try:
+            if len(batch) > 1:
+                ratings = await self._rate(json_dumps([content for content, _ in batch]).decode(),
+                                           self._BATCH_SYS_MSG)
+                if ratings is None:
+                    # The endpoint already failed after retrying, rating one by one would only add more load
+                    return
+                if (isinstance(ratings, list) and len(ratings) == len(batch)
+                        and all(isinstance(rating, dict) for rating in ratings)):
+                    results = ratings
+                else:
+                    # Refusals or a malformed array can't be attributed to single messages, so rate them one by one
+                    self.log.warning(f"Could not use batch rating of {len(batch)} messages, rating individually")
+            if results is None:
+                results = await asyncio.gather(*(self._rate(content) for content, _ in batch))
+        except Exception as e:
+            self.log.error(f"Failed to rate batch of {len(batch)} messages: {e}")
+        finally:
+            # Also runs when the batch failed or was cancelled on stop, in which case the messages are left unrated
+            for i, (_, fut) in enumerate(batch):
+                if not fut.done():
+                    fut.set_result(results[i] if results else None)
+
+    def _retry_delay(self, attempt: int, retry_after: str = None) -> float:
+        """Exponential backoff with jitter, honoring a Retry-After header when the server sends one"""
+        if retry_after:
+            try:
+                return min(self.RETRY_MAX_DELAY, float(retry_after))
+            except ValueError:
+                pass
+        return min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2 ** attempt) + random.uniform(0, self.RETRY_JITTER)
+
+    async def _request_rating(self, data: dict, headers: dict):
+        for attempt in range(self.MAX_RETRIES):
+            retry_after = None
+            try:
+                async with self._ai_session.post(
+                    self.config["ai_mod_api_endpoint"], headers=headers, data=json_dumps(data)
+                ) as response:
+                    if response.status in self.RETRY_STATUSES:
+                        retry_after = response.headers.get("Retry-After")
+                        self.log.warning(f"Attempt {attempt + 1}: AI endpoint returned {response.status}. trying again...")
+                    elif response.status != 200:
+                        self.log.error(f"AI endpoint returned {response.status}: {await response.text()}")
+                        return None
                     else:
-                        self.log.error(f"Attempt {attempt + 1}: {e}. trying again...")
+                        response_json = json_loads(await response.read())
+                        resp_content = response_json["choices"][0]["message"]["content"]
+                        #self.log.debug(f"DEBUG response content: {resp_content}")
+                        try:
+                            rating_json = json_loads(resp_content)
+                            return rating_json
+                        except json.JSONDecodeError as e:
+                            if self.REFUSAL_RE.search(resp_content) is not None:
+                                self.log.debug("LLM indicated content blocking - treating as high risk content")
+                                return {"max": 10, 
+                                    "comment": "LLM indicated content blocking", 
+                                    "analysis": resp_content, 
+                                    "categories": {"unsafe": 10}
+                                    }
+                            else:
+                                self.log.error(f"Attempt {attempt + 1}: {e}. trying again...")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.log.warning(f"Attempt {attempt + 1}: request to AI endpoint failed: {e!r}. trying again...")
+
+            if attempt + 1 < self.MAX_RETRIES:
+                await asyncio.sleep(self._retry_delay(attempt, retry_after))
 
-        self.log.error("Failed to parse JSON after multiple retries.")
+        self.log.error("Failed to get a valid rating after multiple retries.")
         return None
 
     def flag_score(self, rating):
         if rating["max"] >= self.config["ai_mod_threshold"]:
             return True
 
-    async def check_bot_permissions(self, room_id: str, evt: MessageEvent = None, required_permissions: list[str] = None) -> tuple[bool, str, dict]:
+    async def check_bot_permissions(self, room_id: str, evt: MessageEvent = None, required_permissions: list[str] = None,
+                                    power_levels: PowerLevelStateEventContent = None) -> tuple[bool, str, dict]:
         """Check if the bot has necessary permissions in a room.
         
         Args:
             room_id: The ID of the room to check permissions in
             evt: Optional MessageEvent for progress updates
             required_permissions: List of specific permissions to check. If None, checks basic room access.
+            power_levels: Optional already-fetched power levels of the room. If None, they are fetched.
             
         Returns:
             tuple: (bool, str, dict) - (has_permissions, error_message, permission_details)
+            permission_details is only filled in when requested permissions are missing.
         """
         try:
             # Check if bot is in the room
@@ -174,7 +518,8 @@ programmatic content moderation system to work.
                 return False, "Bot is not a member of this room", {}
 
             # Get power levels
-            power_levels = await self.client.get_state_event(room_id, EventType.ROOM_POWER_LEVELS)
+            if power_levels is None:
+                power_levels = await self._get_power_levels(room_id)
             bot_level = power_levels.users.get(self.client.mxid, power_levels.users_default)
             
             # Define required power levels for different actions
@@ -183,35 +528,39 @@ programmatic content moderation system to work.
                 "state": power_levels.state_default
             }
             
-            # Check each required permission
+            # Check each required permission as (has_permission, required_level)
             permission_status = {}
             if required_permissions:
                 for perm in required_permissions:
                     if perm in permission_requirements:
                         required_level = permission_requirements[perm]
-                        permission_status[perm] = {
-                            "has_permission": bot_level >= required_level,
-                            "required_level": required_level,
-                            "bot_level": bot_level
-                        }
+                        permission_status[perm] = (bot_level >= required_level, required_level)
             
             # If no specific permissions requested, just check basic access
             if not required_permissions:
                 if bot_level < 50:  # Basic moderator level
-                    return False, "Bot does not have sufficient power level (needs at least moderator level)", permission_status
-                return True, "", permission_status
+                    return False, "Bot does not have sufficient power level (needs at least moderator level)", {}
+                return True, "", {}
             
             # Check if all requested permissions are granted
-            missing_permissions = [perm for perm, status in permission_status.items() 
-                                 if not status["has_permission"]]
+            missing_permissions = tuple(perm for perm, (has_permission, _) in permission_status.items()
+                                        if not has_permission)
             
             if missing_permissions:
                 error_msg = "Bot is missing required permissions: " + ", ".join(missing_permissions)
-                return False, error_msg, permission_status
+                permission_details = {
+                    perm: {
+                        "has_permission": has_permission,
+                        "required_level": required_level,
+                        "bot_level": bot_level
+                    }
+                    for perm, (has_permission, required_level) in permission_status.items()
+                }
+                return False, error_msg, permission_details
             
-            return True, "", permission_status
+            return True, "", {}
 
-        except Exception as e:
+        except (MatrixError, aiohttp.ClientError, asyncio.TimeoutError) as e:
             error_msg = f"Failed to check bot permissions: {e}"
             self.log.error(error_msg)
             if evt:
@@ -222,20 +571,9 @@ programmatic content moderation system to work.
 
     def is_message_allowed(self, evt: MessageEvent) -> bool:
         """Check if message type and media type are allowed"""
-        # Default allowed message types
-        default_msgtypes = ["m.text", "m.image"]
-        # Default allowed media types
-        default_mimetypes = [
-            "image/jpeg", "image/png", "image/webp", "image/gif"
-        ]
-        
-        # Get configuration
-        allowed_msgtypes = self.config.get("allowed_msgtypes", default_msgtypes)
-        allowed_mimetypes = self.config.get("allowed_mimetypes", default_mimetypes)
-        
         # Check message type
         msgtype = evt.content.msgtype.value
-        if msgtype not in allowed_msgtypes:
+        if msgtype not in self.allowed_msgtypes:
             return False
             
         # For image messages, check mimetype
@@ -243,7 +581,7 @@ programmatic content moderation system to work.
             # Ensure it's a media message before accessing info
             if isinstance(evt.content, MediaMessageEventContent):
                 mimetype = getattr(evt.content.info, "mimetype", None)
-                if mimetype and mimetype not in allowed_mimetypes:
+                if mimetype and mimetype not in self.allowed_mimetypes:
                     return False
                 
         return True
@@ -265,25 +603,24 @@ programmatic content moderation system to work.
 
     @event.on(EventType.ROOM_MESSAGE)
     async def analyze_message(self, evt: MessageEvent) -> None:
-        
+        # The bot itself and admins are never moderated, so skip them before doing any requests
+        if evt.sender == self.client.mxid or evt.sender in self.admins:
+            return
+
         # Skip if it's a file and file moderation is disabled
         if isinstance(evt.content, MediaMessageEventContent) and not self.config["moderate_files"]:
             return
 
-        power_levels = await self.client.get_state_event(
-            evt.room_id, EventType.ROOM_POWER_LEVELS
-        )
+        power_levels = await self._get_power_levels(evt.room_id)
         user_level = power_levels.get_user_level(evt.sender)
+        if user_level >= self.config["uncensor_pl"]:
+            return
 
         # Apply message type filtering if enabled
-        if (self.config.get("enable_msgtype_filter", False) and
-            (evt.sender not in self.config["admins"]) and
-            (user_level < self.config["uncensor_pl"]) and
-            (evt.sender != self.client.mxid) and
-            not self.is_message_allowed(evt)):
+        if self.config.get("enable_msgtype_filter", False) and not self.is_message_allowed(evt):
             
             has_perms, error_msg, perm_details = await self.check_bot_permissions(
-                evt.room_id, evt, ["redact"]
+                evt.room_id, evt, ["redact"], power_levels=power_levels
             )
             
             if has_perms:
@@ -303,41 +640,41 @@ programmatic content moderation system to work.
                 self.log.warning(f"Missing permissions to delete message: {error_msg}")
             return
 
-        # Check if user should have their message analyzed by AI
-        if (evt.sender not in self.config["admins"]
-            and user_level < self.config["uncensor_pl"]
-            and evt.sender != self.client.mxid):
-            # Check bot permissions
+        # Don't bother the AI with empty or trivially short text messages
+        if (evt.content.msgtype == MessageType.TEXT
+            and len((evt.content.body or "").strip()) < self.config["min_moderation_chars"]):
+            return
+
+        # Mark the message read and analyze it with AI concurrently
+        _, score = await asyncio.gather(evt.mark_read(), self.ai_analyze(evt))
+        if not score:  # Skip if analysis failed
+            return
+
+        self.log.debug(f"DEBUG message score: {score['comment']} ({score['analysis']})")
+        
+        # If score is high enough, either redact or notify about missing permissions
+        if self.flag_score(score):
+            # Only check bot permissions once we actually want to redact
             has_perms, error_msg, perm_details = await self.check_bot_permissions(
                 evt.room_id,
                 evt,
-                ["redact"]
+                ["redact"],
+                power_levels=power_levels
             )
-
-            # Analyze message with AI
-            await evt.mark_read()
-            score = await self.ai_analyze(evt)
-            if not score:  # Skip if analysis failed
-                    return
-
-            self.log.debug(f"DEBUG message score: {score['comment']} ({score['analysis']})")
-            
-            # If score is high enough, either redact or notify about missing permissions
-            if self.flag_score(score):
-                if has_perms:
-                    try:
-                        await self.client.redact(
-                            evt.room_id, evt.event_id, reason=score["comment"]
-                        )
-                    except Exception as e:
-                        self.log.error(f"AI-flagged message should be redacted: {e}")
-                else:
-                    # Get the required power level for redaction
-                    redact_pl = perm_details["redact"]["required_level"]
-                    bot_pl = perm_details["redact"]["bot_level"]
-                    await evt.reply(
-                        f"I would have redacted this message ({score['comment']}), but I need a power level of {redact_pl} or higher to do so (currently {bot_pl})."
+            if has_perms:
+                try:
+                    await self.client.redact(
+                        evt.room_id, evt.event_id, reason=score["comment"]
                     )
+                except Exception as e:
+                    self.log.error(f"AI-flagged message should be redacted: {e}")
+            else:
+                # Get the required power level for redaction
+                redact_pl = perm_details["redact"]["required_level"]
+                bot_pl = perm_details["redact"]["bot_level"]
+                await evt.reply(
+                    f"I would have redacted this message ({score['comment']}), but I need a power level of {redact_pl} or higher to do so (currently {bot_pl})."
+                )
 
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]: